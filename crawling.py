@@ -1,11 +1,20 @@
 import os
+import re
+import math
+import json
 import time
+import hashlib
+import random
 import threading
-from queue import Queue
-from urllib.parse import urlparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable, Iterator
+from email.utils import parsedate_to_datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
 from dotenv import load_dotenv
 from tqdm import tqdm
 
@@ -19,6 +28,10 @@ BOARD_ID = os.getenv("PIN_BOARD_ID")
 OUT_DIR = os.getenv("OUT_DIR", "downloads")
 CONCURRENCY = max(1, int(os.getenv("CONCURRENCY", "4")))
 PAGE_SIZE = max(1, min(50, int(os.getenv("PAGE_SIZE", "50"))))
+HTTP_CACHE = os.getenv("HTTP_CACHE", "pinterest_cache")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))
+MAX_RETRY_AFTER = float(os.getenv("MAX_RETRY_AFTER", "600"))  # 서버 Retry-After 힌트 상한(초)
+DOWNLOAD_CHUNK = max(64 * 1024, int(os.getenv("DOWNLOAD_CHUNK", str(1 << 20))))  # 저장소(SSD/NFS)별 튜닝용
 
 if not ACCESS_TOKEN:
     raise SystemExit("환경변수 PIN_ACCESS_TOKEN 가 필요합니다 (.env 설정).")
@@ -28,163 +41,363 @@ if not BOARD_ID:
 BASE = "https://api.pinterest.com/v5"
 HEADERS = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
 
+# 커넥션 풀 공유 세션 (keep-alive 로 TCP/TLS 핸드셰이크 재사용)
+# 토큰이 이미지 CDN 으로 새지 않도록 인증 헤더는 API 호출에만 붙인다.
+def _mount_pool(session: requests.Session) -> requests.Session:
+    adapter = HTTPAdapter(pool_connections=CONCURRENCY, pool_maxsize=CONCURRENCY * 4, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# 핀 목록(API) 전용: 디스크 캐시 + ETag/Last-Modified 재검증
+API_SESSION = _mount_pool(CachedSession(
+    HTTP_CACHE,
+    backend="sqlite",
+    expire_after=CACHE_TTL,
+    cache_control=True,
+    allowable_codes=(200,),
+))
+# 이미지 다운로드 전용: 캐시 없는 일반 세션 (CDN 의 Cache-Control 때문에
+# 본문 전체가 메모리/sqlite 로 들어가지 않도록 스트리밍 경로와 분리)
+SESSION = _mount_pool(requests.Session())
+
 # -------------------------
 # 유틸
 # -------------------------
+# 파일명 금지 문자 + 제어문자(0x00-0x1F) -> "_" 변환 테이블 (import 시 1회 생성)
+_BAD_CHARS = '<>:"/\\|?*' + "".join(chr(i) for i in range(32))
+_FILENAME_TRANS = str.maketrans(_BAD_CHARS, "_" * len(_BAD_CHARS))
+
+# URL 끝(쿼리/프래그먼트 앞)의 이미지 확장자
+_EXT_RE = re.compile(r"\.(jpe?g|png|gif|webp)(?=[?#]|$)", re.I)
+
 def sanitize_filename(name: str, max_len: int = 120) -> str:
     if not name:
         return "untitled"
-    bad = '<>:"/\\|?*\x00-\x1F'
-    for ch in bad:
-        name = name.replace(ch, "_")
     name = "_".join(name.split())  # 공백 압축
+    name = name.translate(_FILENAME_TRANS)
     return name[:max_len].strip("_")
 
 def ensure_dir(path: Path):
     path.mkdir(parents=True, exist_ok=True)
 
-def backoff_sleep(retries: int):
-    # 지수 백오프 (429/5xx 대응)
-    time.sleep(min(60, (2 ** retries)))
+def load_manifest(path: Path) -> dict:
+    # url -> {"etag", "sha256", "path"} (이전 실행에서 받은 이미지 기록, path 는 out_dir 기준 파일명)
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(path: Path, manifest: dict):
+    # 임시 파일에 쓴 뒤 os.replace 로 교체 (중간에 죽어도 기존 매니페스트 유지)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+def retry_after_seconds(response: requests.Response | None) -> float | None:
+    # Retry-After: 초 단위 또는 HTTP-date. inf/nan 은 무시하고,
+    # 먼 미래 날짜 등으로 워커가 멈춰 있지 않도록 MAX_RETRY_AFTER 로 자름
+    ra = response.headers.get("Retry-After") if response is not None else None
+    if not ra:
+        return None
+    try:
+        delay = float(ra)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(ra).timestamp() - time.time()
+        except (TypeError, ValueError, OverflowError):
+            return None
+    if not math.isfinite(delay):
+        return None
+    return min(MAX_RETRY_AFTER, max(0.0, delay))
+
+def claim_filepath(out_dir: Path, base: str, ext: str) -> Path:
+    # 파일명 중복 방지: O_CREAT|O_EXCL 로 빈 파일을 원자적으로 선점
+    # (exists() 검사 후 생성하는 방식은 워커끼리 같은 이름을 고를 수 있음)
+    filepath = out_dir / f"{base}{ext}"
+    idx = 1
+    while True:
+        try:
+            os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return filepath
+        except FileExistsError:
+            filepath = out_dir / f"{base}_{idx}{ext}"
+            idx += 1
+
+def interruptible_sleep(delay: float, cancel: threading.Event | None = None):
+    # cancel 이 주어지면 취소(Ctrl-C 등) 시 바로 깨어남
+    if cancel is not None:
+        cancel.wait(delay)
+    else:
+        time.sleep(delay)
+
+def backoff_sleep(
+    prev: float,
+    response: requests.Response | None = None,
+    cancel: threading.Event | None = None,
+) -> float:
+    # 429/5xx 대응: 서버의 Retry-After(최대 MAX_RETRY_AFTER) 우선, 없으면 decorrelated jitter
+    # (워커들이 같은 박자로 재시도하지 않도록, 최대 60초). 실제 대기 시간을 반환.
+    delay = retry_after_seconds(response)
+    if delay is None:
+        delay = min(60.0, random.uniform(1.0, max(1.0, prev) * 3))
+    interruptible_sleep(delay, cancel)
+    return delay
+
+class DownloadCancelled(Exception):
+    # Ctrl-C 등으로 Downloader 가 취소 신호를 보내 중단된 다운로드
+    pass
+
+class CircuitBreaker:
+    # 같은 호스트로 가는 워커들이 공유: 429 가 연속 threshold 번 나오면
+    # Retry-After(최대 MAX_RETRY_AFTER, 없으면 cooldown) 동안 모든 워커가 요청 전에 함께 쉰다.
+    def __init__(self, threshold: int = 3, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, cancel: threading.Event | None = None):
+        delay = self.open_until - time.monotonic()
+        if delay > 0:
+            interruptible_sleep(delay, cancel)
+
+    def record(self, response: requests.Response):
+        with self.lock:
+            if response.status_code == 200:
+                self.failures = 0
+            elif response.status_code == 429:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    cooldown = retry_after_seconds(response)
+                    if cooldown is None:
+                        cooldown = self.cooldown
+                    self.open_until = max(self.open_until, time.monotonic() + cooldown)
+
+API_BREAKER = CircuitBreaker()
+CDN_BREAKER = CircuitBreaker()
 
 # -------------------------
 # Pinterest API
 # -------------------------
-def fetch_pins_page(board_id: str, bookmark: str | None, page_size: int = 50):
+def fetch_pins_page(
+    board_id: str,
+    bookmark: str | None,
+    page_size: int = 50,
+    session: requests.Session = API_SESSION,
+    breaker: CircuitBreaker = API_BREAKER,
+):
     params = {"page_size": str(page_size)}
     if bookmark:
         params["bookmark"] = bookmark
 
     retries = 0
+    delay = 1.0
     while True:
-        r = requests.get(f"{BASE}/boards/{board_id}/pins", headers=HEADERS, params=params, timeout=30)
+        breaker.wait()
+        r = session.get(f"{BASE}/boards/{board_id}/pins", headers=HEADERS, params=params, timeout=30)
+        breaker.record(r)
         if r.status_code == 200:
             return r.json()
         if r.status_code in (429, 500, 502, 503, 504) and retries < 5:
             retries += 1
-            backoff_sleep(retries)
+            delay = backoff_sleep(delay, r)
             continue
         raise RuntimeError(f"핀 목록 요청 실패 {r.status_code}: {r.text}")
 
+def iter_board_pages(board_id: str, page_size: int = 50) -> Iterator[list[dict]]:
+    # bookmark 커서를 따라가며 페이지 단위로 핀 목록을 넘겨줌
+    bookmark = None
+    while True:
+        data = fetch_pins_page(board_id, bookmark, page_size)
+        items = data.get("items", [])
+        yield items
+        bookmark = data.get("bookmark")
+        if not bookmark or not items:
+            return
+
+IMAGE_SIZE_ORDER = ("orig", "xlarge", "large", "medium", "small")
+
 def pick_best_image(pin: dict) -> dict | None:
     # v5: pin.media.images.orig/xlarge/large/medium/small ...
     media = pin.get("media", {})
     images = media.get("images", {}) if isinstance(media, dict) else {}
 
-    order = ["orig", "xlarge", "large", "medium", "small"]
-    for key in order:
+    for key in IMAGE_SIZE_ORDER:
         img = images.get(key)
         if isinstance(img, dict) and img.get("url"):
             return img
 
-    # 예외 구조 대비: pin.images.* 가 있을 수 있음
+    # 예외 구조 대비: pin.images.* 가 있을 수 있음 (가장 넓은 것 하나만 필요하므로 정렬 대신 max)
     fallback = pin.get("images", {})
     if isinstance(fallback, dict) and fallback:
-        sizes = sorted(
-            [v for v in fallback.values() if isinstance(v, dict) and v.get("url")],
+        return max(
+            (v for v in fallback.values() if isinstance(v, dict) and v.get("url")),
             key=lambda x: (x.get("width") or 0),
-            reverse=True,
+            default=None,
         )
-        if sizes:
-            return sizes[0]
     return None
 
-def stream_download(url: str, filepath: Path):
+def stream_download(
+    url: str,
+    filepath: Path,
+    session: requests.Session = SESSION,
+    breaker: CircuitBreaker = CDN_BREAKER,
+    cancel: threading.Event | None = None,
+) -> tuple[str | None, str]:
+    # 받는 중에는 ".part" 에 쓰고, 끝까지 받은 뒤에만 원래 이름으로 교체
+    # (강제 종료돼도 잘린 파일이 완성본 이름으로 남지 않음)
+    partpath = filepath.with_name(filepath.name + ".part")
     retries = 0
-    while True:
-        with requests.get(url, stream=True, timeout=60) as r:
-            if r.status_code == 200:
-                with open(filepath, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1024 * 256):
-                        if chunk:
+    delay = 1.0
+    try:
+        while True:
+            breaker.wait(cancel)
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled(url)
+            with session.get(url, stream=True, timeout=60) as r:
+                breaker.record(r)
+                if r.status_code == 200:
+                    # 소켓 -> 파일 DOWNLOAD_CHUNK 단위 복사 (gzip 등은 디코딩), 쓰면서 SHA-256 계산
+                    r.raw.decode_content = True
+                    h = hashlib.sha256()
+                    with open(partpath, "wb", buffering=0) as f:
+                        for chunk in iter(lambda: r.raw.read(DOWNLOAD_CHUNK), b""):
+                            if cancel is not None and cancel.is_set():
+                                raise DownloadCancelled(url)
+                            h.update(chunk)
                             f.write(chunk)
-                return
-            if r.status_code in (429, 500, 502, 503, 504) and retries < 5:
-                retries += 1
-                backoff_sleep(retries)
-                continue
-            raise RuntimeError(f"다운로드 실패 {r.status_code} {url}")
+                    os.replace(partpath, filepath)
+                    return r.headers.get("ETag"), h.hexdigest()
+                if r.status_code in (429, 500, 502, 503, 504) and retries < 5:
+                    retries += 1
+                    delay = backoff_sleep(delay, r, cancel)
+                    continue
+                raise RuntimeError(f"다운로드 실패 {r.status_code} {url}")
+    except BaseException:
+        # 받다 만 파일과 선점해 둔 빈 파일 정리
+        partpath.unlink(missing_ok=True)
+        filepath.unlink(missing_ok=True)
+        raise
 
 # -------------------------
-# 작업 큐(멀티스레드)
+# 다운로드 풀(멀티스레드)
 # -------------------------
 class Downloader:
-    def __init__(self, out_dir: Path, concurrency: int = 4):
+    def __init__(self, out_dir: Path, concurrency: int = 4, session: requests.Session = SESSION):
         self.out_dir = out_dir
-        self.q: Queue[dict] = Queue()
+        self.session = session
         self.bar = None
         self.total = 0
-        self.lock = threading.Lock()
-        self.threads = []
+        self.pins_seen = 0
+        self.pages_seen = 0
+        self.existing_ids: set[str] = set()
+        self.seen: set[str] = set()
+        self.done: deque = deque()
+        self.cancel = threading.Event()
+        self.manifest_path = out_dir / "manifest.json"
+        self.manifest: dict = {}
         self.concurrency = concurrency
 
-    def worker(self):
-        while True:
-            job = self.q.get()
-            if job is None:
-                self.q.task_done()
-                break
-            pin = job["pin"]
-            try:
-                img = pick_best_image(pin)
-                if not img or not img.get("url"):
-                    # 이미지 없는 핀은 스킵
-                    self._tick()
-                    self.q.task_done()
+    def _download_one(self, pin: dict, url: str):
+        m = _EXT_RE.search(url)
+        ext = "." + m.group(1).lower() if m else ".jpg"
+
+        title = pin.get("title") or pin.get("description") or ""
+        base = sanitize_filename(f'{pin.get("id","")}_{title}')
+        if not base:
+            base = str(pin.get("id", "pin"))
+        filepath = claim_filepath(self.out_dir, base, ext)
+        etag, sha256 = stream_download(url, filepath, self.session, cancel=self.cancel)
+        self.manifest[url] = {"etag": etag, "sha256": sha256, "path": filepath.name}
+
+    def _scan_existing(self):
+        # 파일명은 "{pin_id}_{title}{ext}" 형식이므로 앞부분으로 pin id 를 복원
+        # 강제 종료된 이전 실행이 남긴 ".part" 와 선점만 된 빈 파일은 지워서
+        # "받음"으로 치지도 않고, claim_filepath 가 "_1" 같은 새 이름으로 밀려나지도 않게 함
+        self.existing_ids = set()
+        with os.scandir(self.out_dir) as it:
+            for e in it:
+                if not e.is_file():
                     continue
+                if e.name.endswith(".part") or e.stat().st_size == 0:
+                    Path(e.path).unlink(missing_ok=True)
+                    continue
+                self.existing_ids.add(e.name.split("_", 1)[0].split(".", 1)[0])
 
-                url = img["url"]
-                ext = Path(urlparse(url).path).suffix or ".jpg"
-
-                title = pin.get("title") or pin.get("description") or ""
-                base = sanitize_filename(f'{pin.get("id","")}_{title}')
-                if not base:
-                    base = str(pin.get("id", "pin"))
-                filepath = self.out_dir / f"{base}{ext}"
-
-                # 파일명 중복 방지
-                idx = 1
-                while filepath.exists():
-                    filepath = self.out_dir / f"{base}_{idx}{ext}"
-                    idx += 1
-
-                stream_download(url, filepath)
-            except Exception as e:
-                # 실패해도 다음 작업 진행
-                # 필요시 로그 파일에 기록하도록 수정 가능
-                pass
-            finally:
-                self._tick()
-                self.q.task_done()
-
-    def _tick(self):
-        if self.bar:
-            with self.lock:
-                self.bar.update(1)
-
-    def run(self, pins: list[dict]):
-        self.total = len(pins)
-        ensure_dir(self.out_dir)
-        self.bar = tqdm(total=self.total, unit="img", desc="다운로드")
-
-        # 워커 시작
-        for _ in range(self.concurrency):
-            t = threading.Thread(target=self.worker, daemon=True)
-            t.start()
-            self.threads.append(t)
-
-        # 큐 적재
+    def plan(self, pins: list[dict]) -> list[dict]:
+        # 작업 제출 전에 걸러내기: 이미지 없는 핀, 보드 안 중복 URL, 이전 실행에서 이미 받은 핀/URL
+        jobs = []
         for pin in pins:
-            self.q.put({"pin": pin})
-
-        # 종료 신호
-        for _ in range(self.concurrency):
-            self.q.put(None)
-
-        self.q.join()
-        for t in self.threads:
-            t.join()
-        self.bar.close()
+            img = pick_best_image(pin)
+            url = img.get("url") if img else None
+            pin_id = str(pin.get("id") or "")
+            if not url or url in self.seen or (pin_id and pin_id in self.existing_ids):
+                continue
+            entry = self.manifest.get(url)
+            if entry and (self.out_dir / entry["path"]).exists():
+                continue
+            self.seen.add(url)
+            jobs.append({"pin": pin, "url": url})
+        return jobs
+
+    def _tick(self, fut):
+        # 실패한 작업도 카운트만 하고 다음 작업 진행
+        # 필요시 fut.exception() 을 로그 파일에 기록하도록 수정 가능
+        # deque.append 는 원자적이라 워커끼리 락 경쟁 없음
+        # 중단으로 취소됐거나 받던 중 끊긴 작업은 완료로 치지 않음
+        if fut.cancelled() or isinstance(fut.exception(), DownloadCancelled):
+            return
+        self.done.append(1)
+
+    def _sync_bar(self):
+        self.bar.total = self.total
+        self.bar.n = len(self.done)
+        self.bar.refresh()
+
+    def _refresh_bar(self, stop: threading.Event):
+        # 진행바는 이 스레드만 건드림: 완료 수를 10Hz 로 모아서 반영
+        while not stop.wait(0.1):
+            self._sync_bar()
+        self._sync_bar()
+
+    def run(self, pages: Iterable[list[dict]]):
+        ensure_dir(self.out_dir)
+        self._scan_existing()
+        self.manifest = load_manifest(self.manifest_path)
+        self.bar = tqdm(total=0, unit="img", desc="다운로드")
+        stop = threading.Event()
+        ticker = threading.Thread(target=self._refresh_bar, args=(stop,), daemon=True)
+        ticker.start()
+
+        ex = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            try:
+                # 목록 페이지를 받는 즉시 제출: 다음 페이지 요청과 이미지 다운로드가 겹쳐 진행됨
+                for pins in pages:
+                    self.pins_seen += len(pins)
+                    self.pages_seen += 1
+                    jobs = self.plan(pins)
+                    self.total += len(jobs)
+                    for job in jobs:
+                        ex.submit(self._download_one, job["pin"], job["url"]).add_done_callback(self._tick)
+                ex.shutdown(wait=True)
+            except (KeyboardInterrupt, SystemExit):
+                # Ctrl-C 등: 대기 중인 작업은 취소, 진행 중인 다운로드는 다음 청크에서 중단
+                self.cancel.set()
+                ex.shutdown(wait=True, cancel_futures=True)
+                raise
+            except BaseException:
+                # 목록 요청 실패 등: 이미 제출한 다운로드는 끝까지 받은 뒤 예외 전달
+                ex.shutdown(wait=True)
+                raise
+        finally:
+            stop.set()
+            ticker.join()
+            self.bar.close()
+            # 풀이 멈춘 뒤 저장 (정리 중 한 번 더 중단되면 그 시점 스냅샷이라도 저장)
+            save_manifest(self.manifest_path, dict(self.manifest))
 
 # -------------------------
 # 실행
@@ -193,26 +406,14 @@ def main():
     out_dir = Path(OUT_DIR)
     ensure_dir(out_dir)
 
-    pins = []
-    bookmark = None
-    total_pages = 0
-
-    while True:
-        data = fetch_pins_page(BOARD_ID, bookmark, PAGE_SIZE)
-        items = data.get("items", [])
-        pins.extend(items)
-        bookmark = data.get("bookmark")
-        total_pages += 1
-        if not bookmark or not items:
-            break
+    dl = Downloader(out_dir=out_dir, concurrency=CONCURRENCY)
+    dl.run(iter_board_pages(BOARD_ID, PAGE_SIZE))
 
-    if not pins:
+    if not dl.pins_seen:
         print("가져올 핀이 없습니다. (보드 ID/권한/토큰/스코프 확인)")
         return
 
-    print(f"총 {len(pins)}개 핀 수집, {total_pages} 페이지.")
-    dl = Downloader(out_dir=out_dir, concurrency=CONCURRENCY)
-    dl.run(pins)
+    print(f"총 {dl.pins_seen}개 핀 수집, {dl.pages_seen} 페이지.")
     print("✅ 완료!")
 
 if __name__ == "__main__":